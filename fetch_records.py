@@ -12,24 +12,35 @@
 # also listed in aws open data registry https://registry.opendata.aws/nara-national-archives-catalog/
 
 import argparse
-import json
-import multiprocessing
+import asyncio
+import csv
+import functools
+import itertools
 import os
 import re
+from http import HTTPStatus
 from pathlib import Path
+from urllib.parse import urlsplit
 
-import pandas as pd
+import aiofiles
+import aiohttp
+import orjson
 import requests
-from benedict import benedict
 from dotenv import load_dotenv
-from tqdm.contrib.concurrent import process_map
+from tqdm.asyncio import tqdm
 
-num_cpu = multiprocessing.cpu_count() - 1
+# cap on concurrent in-flight downloads
+max_downloads = 64
+# streaming write chunk size: caps memory per in-flight download at 64KB
+chunk_size = 1 << 16
 
+_SNAKE_RE = re.compile(r'(\s|[^\w])+')
 
+
+@functools.lru_cache(maxsize=None)
 def to_snake_case(x: str) -> str:
     '''
-    Convert text to snake case.  
+    Convert text to snake case. Results are cached, since titles repeat within a series.
 
     Args:
         x (str): String to convert
@@ -37,36 +48,29 @@ def to_snake_case(x: str) -> str:
     Returns:
         str: String with spaces and non-word characters replaced with underscores, and all characters in lower case.
     '''
-    return re.sub(r'(\s|[^\w])+', '_', x.lower())
+    return _SNAKE_RE.sub('_', x.lower())
 
 
-def get_records(obj: dict, path: list[str], key: str) -> dict | None:
+def _dig(d: dict, path: list[str]):
     '''
-    Subset a record dict to get its metadata and digital objects.  
+    Walk a nested dict along a path of keys, returning `None` if any key is missing.
 
     Args:
-        obj (dict): Dict of a record
-        path (list[str]): List of strings giving the path to the digital objects
-        key (str): String giving the digital objects key
+        d (dict): Dict to walk
+        path (list[str]): List of keys giving the path to follow
 
     Returns:
-        dict | None: If keys are found, returns a benedict object with keys `meta` and `objs`. Else returns `None`.
+        Value at the end of the path, or `None`.
     '''
-    x = benedict(obj)[path]
-    if isinstance(x, benedict) and key in x:
-        return {
-            'meta': x.subset(['recordType', 'title', 'naId']),
-            'objs': x[key]
-        }
-    else:
-        return None
+    return functools.reduce(
+        lambda o, k: o.get(k) if isinstance(o, dict) else None, path, d)
 
 
-def recs_to_df(obj: dict,
-               path: list[str] = ['_source', 'record'],
-               key: str = 'digitalObjects') -> dict | None:
+def get_records(obj: dict,
+                path: list[str] = ['_source', 'record'],
+                key: str = 'digitalObjects') -> dict | None:
     '''
-    Generate metadata & a dataframe of digital objects data from a record dict.
+    Subset a record dict to get its metadata and digital objects.
 
     Args:
         obj (dict): Dict of a record
@@ -74,20 +78,22 @@ def recs_to_df(obj: dict,
         key (str, optional): String giving the digital objects key. Defaults to 'digitalObjects'.
 
     Returns:
-        dict | None: If records are found, returns a dict with keys `meta` and `objs`, where objs is a dataframe. Else returns `None`.
+        dict | None: If keys are found and the record has any digital objects, returns a dict with keys `meta` and `objs`, where objs is a list of dicts. Else returns `None`.
     '''
-    recs = get_records(obj, path, key)
-    if recs is not None:
-        recs['objs'] = pd.DataFrame(recs['objs'])
-        # recs is now a dict of meta = benedict, objs = df
-        return recs
+    x = _dig(obj, path)
+    # treat an empty digitalObjects list the same as a missing key
+    if isinstance(x, dict) and x.get(key):
+        return {
+            'meta': {k: x.get(k) for k in ('recordType', 'title', 'naId')},
+            'objs': x[key]
+        }
     else:
         return None
 
 
 def prep_dirs(base_output: str, id: str, title: str) -> Path:
     '''
-    Prep directory for a collection's output files.
+    Build the path to a collection's output directory. Pure path computation: directories are created in one batch in `main`.
 
     Args:
         base_output (str): String giving the base output directory
@@ -100,106 +106,222 @@ def prep_dirs(base_output: str, id: str, title: str) -> Path:
     # ensure short enough for file name--ID will keep deidentified
     title = to_snake_case(title)
     direc_name = f'{id}_{title}'
-    direc_path = Path(base_output) / direc_name[0:255]
-    direc_path.mkdir(parents=True, exist_ok=True)
-    return direc_path
+    return Path(base_output) / direc_name[0:255]
 
 
-def prep_output(output_dir: str, item: dict) -> pd.DataFrame:
+def prep_output(output_dir: str, item: dict) -> list[tuple[str, str]]:
     '''
     Setup records' directories, writing objects to a csv file.
 
     Args:
         output_dir (str): String giving output directory path
-        item (dict): Dict of a record with keys `meta` and `objs`, where objs is a dataframe
+        item (dict): Dict of a record with keys `meta` and `objs`, where objs is a list of dicts
 
     Returns:
-        pd.DataFrame: Returns pandas dataframe with columns `objectUrl` and `path`, giving the url to download from and the path to write to.
+        list[tuple[str, str]]: Returns list of (url, path) tuples, giving the url to download from and the path to write to.
     '''
-    # make directory from meta, write df to csv
+    # make directory from meta, write objects to csv
     # output paths based on dir
     meta = item['meta']
-    df = item['objs']
+    objs = item['objs']
     id = meta['naId']
     direc_path = prep_dirs(base_output=output_dir, id=id, title=meta['title'])
     csv_path = direc_path / f'records_{id}.csv'
-    # write csv
-    df.to_csv(csv_path, index=False)
+    # write csv; keys can vary between objects, so take their union in order
+    fieldnames = list(dict.fromkeys(k for o in objs for k in o))
+    with open(csv_path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(objs)
 
-    df['path'] = df['objectFilename'].apply(lambda x: direc_path / x)
-    return df[['objectUrl', 'path']]
+    prefix = str(direc_path) + os.sep
+    return [(o['objectUrl'], prefix + o['objectFilename']) for o in objs]
 
 
-def download_single(url: str, path: Path | str) -> Path | None:
+async def _download_one(session: aiohttp.ClientSession,
+                        sem: asyncio.Semaphore,
+                        url: str,
+                        path: str) -> str | None:
     '''
-    Download a single file from its s3 url and write to a local file. Only downloads and writes if the file does not already exist.
+    Download a single file from its s3 url and write to a local file. Files that already exist in full are skipped; partial files from an interrupted run are resumed.
 
     Args:
+        session (aiohttp.ClientSession): Session shared by all downloads
+        sem (asyncio.Semaphore): Semaphore bounding concurrent downloads
         url (str): URL to download file from
-        path (Path): Path to write the file to
+        path (str): Path to write the file to
 
     Returns:
-        Path | None: If a file is downloaded & written, returns the path to the file. Else returns `None`.
+        str | None: If a file is downloaded & written, returns the path to the file. Else returns `None`.
     '''
-    if not isinstance(path, Path):
-        path = Path(path)
-    if not path.exists():
-        resp = requests.get(url)
-        if resp.status_code == requests.codes.ok:
-            with open(path, 'wb') as file:
-                file.write(resp.content)
-                return path
-        else:
-            return None
-
-
-def fetch_records(id: str,
-                  json_out: str | Path,
-                  key_name: str = 'NARA_KEY',
-                  limit: int = 50) -> benedict:
+    async with sem:
+        hdrs = {}
+        mode = 'wb'
+        if os.path.exists(path):
+            # cheap HEAD tells complete files (skip) from partial ones (resume)
+            size = os.path.getsize(path)
+            async with session.head(url, allow_redirects=True) as head:
+                if int(head.headers.get('Content-Length', -1)) == size:
+                    return None
+            hdrs = {'Range': f'bytes={size}-'}
+        # context managers release connections back to the pool deterministically,
+        # even on early returns--otherwise streamed responses would hold their
+        # sockets and starve the pool under high concurrency
+        async with session.get(url, headers=hdrs) as resp:
+            if not resp.ok:
+                return None
+            if resp.status == HTTPStatus.PARTIAL_CONTENT:
+                # server honored the range; append to the partial file
+                mode = 'ab'
+            async with aiofiles.open(path, mode) as file:
+                # stream to disk instead of buffering the whole file in memory
+                async for chunk in resp.content.iter_chunked(chunk_size):
+                    await file.write(chunk)
+            return path
+
+
+def prep_page(page: dict, output_dir: str) -> tuple[int, list[tuple[str, str]]]:
     '''
-    Prep and make request to the NARA API to get records for a given parent series ID, then write results to json file.  
+    Extract digital objects from one page of API results, setting up directories and metadata csvs.
 
     Args:
-        id (str): Parent ID of series 
-        json_out (str | Path): Path to write json file of results
-        key_name (str): Name of the environment variable containing the NARA API key. Defaults "NARA_KEY".
-        limit (int, optional): Number of record sets to return. Defaults to 50.
+        page (dict): Parsed JSON response for one page
+        output_dir (str): String giving output directory path
 
     Returns:
-        benedict: Returns response JSON as a benedict object.
+        tuple[int, list[tuple[str, str]]]: Number of records with digital objects, and a list of (url, path) tuples to download.
+    '''
+    hits = _dig(page, ['body', 'hits', 'hits']) or []
+    items = [get_records(x) for x in hits]
+    # create the page's output directories up front, one mkdir per unique dir
+    unique_dirs = {
+        prep_dirs(output_dir, it['meta']['naId'], it['meta']['title'])
+        for it in items if it is not None
+    }
+    for direc in unique_dirs:
+        direc.mkdir(parents=True, exist_ok=True)
+    prepped_items = [
+        prep_output(output_dir, item) for item in items if item is not None
+    ]
+    # group urls by host so consecutive downloads reuse keep-alive connections
+    pairs = sorted(itertools.chain.from_iterable(prepped_items),
+                   key=lambda p: urlsplit(p[0]).netloc)
+    return len(prepped_items), pairs
+
+
+async def _run_pages(pages, output_dir: str) -> tuple[list[bytes], int]:
+    '''
+    Consume pages of API results as they arrive, downloading each page's files while the next page is being fetched.
+
+    Args:
+        pages: Iterator of (raw bytes, parsed dict) pages from `fetch_pages`
+        output_dir (str): String giving output directory path
+
+    Returns:
+        tuple[list[bytes], int]: Raw bytes of all pages fetched, and the number of records with digital objects.
+    '''
+    conn = aiohttp.TCPConnector(limit=max_downloads,
+                                limit_per_host=16,
+                                use_dns_cache=True,
+                                ttl_dns_cache=300)
+    hdrs = {
+        'User-Agent': 'nara-manifests scraper',
+        # objects are already-compressed media; skip recompression
+        'Accept-Encoding': 'identity'
+    }
+    sem = asyncio.Semaphore(max_downloads)
+    raws = []
+    n_items = 0
+    async with aiohttp.ClientSession(connector=conn, headers=hdrs) as session:
+        tasks = []
+        next_page = asyncio.create_task(asyncio.to_thread(next, pages, None))
+        while (page := await next_page) is not None:
+            # start fetching the next page while this page's downloads run
+            next_page = asyncio.create_task(
+                asyncio.to_thread(next, pages, None))
+            raw, parsed = page
+            raws.append(raw)
+            n_recs, pairs = prep_page(parsed, output_dir)
+            n_items += n_recs
+            tasks += [
+                asyncio.create_task(_download_one(session, sem, url, path))
+                for url, path in pairs
+            ]
+        if tasks:
+            # cute progress bar over every download queued across all pages
+            await tqdm.gather(*tasks)
+    return raws, n_items
+
+
+def fetch_pages(id: str,
+                key_name: str = 'NARA_KEY',
+                page_size: int = 200,
+                limit: int | None = None):
+    '''
+    Request records from the NARA API for a given parent series ID, one page at a time.
+
+    Args:
+        id (str): Parent ID of series
+        key_name (str): Name of the environment variable containing the NARA API key. Defaults "NARA_KEY".
+        page_size (int, optional): Number of records to request per page. Defaults to 200.
+        limit (int | None, optional): Max number of records to fetch in total, or `None` to fetch all. Defaults to `None`.
+
+    Yields:
+        tuple[bytes, dict]: Raw response bytes & parsed JSON for each page.
     '''
     base_url = 'https://catalog.archives.gov/api/v2/records/parentNaId'
     url = f'{base_url}/{id}'
 
+    api_key = os.getenv(key_name)
     hdrs = {
         'Content-Type': 'application/json',
-        'x-api-key': os.getenv(key_name)
+        'x-api-key': api_key
     }
-    prms = {'limit': limit}
-    resp = requests.get(url, headers=hdrs, params=prms)
-    # print(f'Request status: {resp.status_code}')
-    resp.raise_for_status()
-    # compare total record count to limit, print message if limit is lower
-    resp_json = resp.json()
-    json_bene = benedict(resp_json)
-    total = int(json_bene[['body', 'hits', 'total', 'value']])  # type: ignore
-    if total > limit:
-        print(f'Warning: series {id} has {
-              total} records, but limit is set to {limit}.')
-
-    with open(json_out, 'w') as file:
-        json.dump(resp_json, file)
-        print(f'Results written to {json_out}')
-    return json_bene
-
-
-def get_args() -> tuple[str, int, bool]:
+    offset = 0
+    total = None
+    # one session for the whole series: DNS + TLS are resolved once, then
+    # every page rides the same keep-alive connection
+    with requests.Session() as session:
+        session.headers.update(hdrs)
+        while True:
+            per_page = page_size if limit is None else min(
+                page_size, limit - offset)
+            prms = {'limit': per_page, 'offset': offset}
+            resp = session.get(url, params=prms)
+            resp.raise_for_status()
+            raw = resp.content
+            page = orjson.loads(raw)
+            if total is None:
+                total = int(_dig(page, ['body', 'hits', 'total', 'value']) or 0)
+                print(f'Series {id} has {total} records.')
+            yield raw, page
+            hits = _dig(page, ['body', 'hits', 'hits']) or []
+            offset += len(hits)
+            if len(hits) < per_page or offset >= total:
+                break
+            if limit is not None and offset >= limit:
+                break
+
+
+def write_results(json_out: str | Path, raws: list[bytes]) -> None:
     '''
-    Process command line arguments.  
+    Write raw page responses to a single json file as an array, without re-encoding.
+
+    Args:
+        json_out (str | Path): Path to write json file of results
+        raws (list[bytes]): Raw response bytes of each page
+    '''
+    with open(json_out, 'wb') as file:
+        file.write(b'[' + b','.join(raws) + b']')
+    print(f'Results written to {json_out}')
+
+
+def get_args() -> tuple[str, int | None, bool]:
+    '''
+    Process command line arguments.
 
     Returns:
-        tuple[str, int, bool]: Returns a tuple of the parent series ID, limit for records query, and boolean indicating whether this is a dry run with no downloads.
+        tuple[str, int | None, bool]: Returns a tuple of the parent series ID, max number of records to fetch (`None` for all), and boolean indicating whether this is a dry run with no downloads.
     '''
     prsr = argparse.ArgumentParser(
         prog='NARA scraper',
@@ -212,8 +334,8 @@ def get_args() -> tuple[str, int, bool]:
     prsr.add_argument('-l',
                       '--limit',
                       type=int,
-                      help='Limit: total number of records to fetch (default: %(default)s)',
-                      default=50)
+                      help='Limit: max number of records to fetch (default: fetch all)',
+                      default=None)
     prsr.add_argument(
         '-n',
         '--no_download',
@@ -236,38 +358,20 @@ def main() -> None:
     json_out = f'results_{base_id}.json'
     output_dir = f'output_{base_id}'
 
-    # make api request for records, return benedict object, pluck out hits
-    # in the process, write out results of api call to json
-    results = fetch_records(id=base_id,
-                            json_out=json_out,
-                            key_name='NARA_KEY',
-                            limit=limit)
+    # make api requests for records page by page, writing results to json
+    pages = fetch_pages(id=base_id, key_name='NARA_KEY', limit=limit)
     if no_download:
+        write_results(json_out, [raw for raw, _ in pages])
         print(f'Skipping download; see {json_out} for results\n')
         return
-    records = results[['body', 'hits', 'hits']]
 
-    # extract digitalObjects where they exist
-    items = [recs_to_df(x) for x in records]
-    # items is list of dicts, with meta = dict, objs = df--bind into single df
-    prepped_items = [
-        prep_output(output_dir, item) for item in items if item is not None
-    ]
-    n_items = len(prepped_items)
-    # if df is empty, exit script
+    # download each page's files while the next page is fetched
+    raws, n_items = asyncio.run(_run_pages(pages, output_dir))
+    write_results(json_out, raws)
     if n_items == 0:
         print('No digitized records found.')
-        return
     else:
         print(f'{n_items} digitized records found.')
-    items_df = pd.concat(prepped_items)
-
-    # download files in parallel with cute progress bar
-    process_map(download_single,
-                items_df['objectUrl'],
-                items_df['path'],
-                max_workers=num_cpu,
-                chunksize=10)
 
 
 if __name__ == '__main__':